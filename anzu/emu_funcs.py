@@ -266,19 +266,15 @@ class LPTEmulator(object):
         if not self.tanh:
             filter_tanh = np.ones_like(filter_tanh)
 
-        newsimoverlpt = 1.*simoverlpt
-        for i in range(nz):
-            for j in range(nspec):
-                meanratio = np.mean(simoverlpt, axis=0)[i, j]
-
-                offset = np.mean(meanratio[offidx])
-                if not self.offset:
-                    offset = 0
-
-                newsimoverlpt[:, i, j] -= offset
-                # Filter only the cubic spectra
-                if j in range(nspec):
-                    newsimoverlpt[:, i, j] *= filter_tanh
+        # Offset for every redshift bin and spectrum at once, shape (nz, nspec)
+        if self.offset:
+            meanratio = np.mean(simoverlpt, axis=0)
+            offset = np.mean(meanratio[..., offidx], axis=-1)
+        else:
+            offset = np.zeros((nz, nspec))
+
+        newsimoverlpt = simoverlpt - offset[np.newaxis, :, :, np.newaxis]
+        newsimoverlpt *= filter_tanh
 
         return newsimoverlpt
 
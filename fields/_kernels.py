@@ -0,0 +1,152 @@
+import numpy as np
+from numba import njit, prange
+
+try:
+    import cupy as cp
+    from cupyx.scipy import fft as cufft
+except ImportError:
+    cp = None
+
+#Floor for k^2 when taking 1/k^2. Only the k=0 mode ever hits it.
+_TINY = np.finfo(np.float64).tiny
+
+
+@njit(parallel=True, cache=True, fastmath=True)
+def build_tide_kernels(delta_k, kx, ky, kz, out_xx, out_xy, out_xz, out_yy, out_yz, out_zz):
+    '''
+    Fills the six independent components of the Fourier-space tidal tensor
+
+    s_ij = (k_i k_j / k^2 - delta_ij / 3 ) * delta_k
+
+    in a single sweep over the local modes.
+
+    Inputs:
+    delta_k: fft'd density, slab-decomposed.
+    kx, ky, kz: 1-D wavenumbers along the first, second and third axis of delta_k.
+    out_xx, ..., out_zz: complex64 arrays shaped like delta_k, overwritten.
+
+    The k=0 mode only keeps the -delta_ij/3 term: k^2 is clamped to the
+    smallest normal double before taking the reciprocal, so the k_i k_j
+    factors (all exactly zero there) keep that mode's anisotropic part at
+    zero without a branch in the inner loop.
+    '''
+    for i in prange(delta_k.shape[0]):
+        kxi = kx[i]
+        for j in range(delta_k.shape[1]):
+            kyj = ky[j]
+            kperp2 = kxi*kxi + kyj*kyj
+            for k in range(delta_k.shape[2]):
+                kzk = kz[k]
+                inv_k2 = 1.0/max(kperp2 + kzk*kzk, _TINY)
+                d = delta_k[i, j, k]
+                out_xx[i, j, k] = (kxi*kxi*inv_k2 - 1./3)*d
+                out_xy[i, j, k] = (kxi*kyj*inv_k2)*d
+                out_xz[i, j, k] = (kxi*kzk*inv_k2)*d
+                out_yy[i, j, k] = (kyj*kyj*inv_k2 - 1./3)*d
+                out_yz[i, j, k] = (kyj*kzk*inv_k2)*d
+                out_zz[i, j, k] = (kzk*kzk*inv_k2 - 1./3)*d
+
+
+@njit(parallel=True, cache=True, fastmath=True)
+def reduce_tidesq(real_batch, weights, tidesq):
+    '''
+    Computes s^2 = sum_c weights[c] * real_batch[c]**2 over the leading
+    component axis in one pass, overwriting and returning tidesq.
+    Off-diagonal components of s_ij appear twice in s_ij s_ij, so they are
+    passed with weight 2.
+
+    The component loop sits outside the innermost axis so each output row
+    stays in cache while the six contiguous input rows stream through it.
+    '''
+    ncomp, n0, n1, n2 = real_batch.shape
+    for i in prange(n0):
+        for j in range(n1):
+            for k in range(n2):
+                tidesq[i, j, k] = 0.
+            for c in range(ncomp):
+                w = weights[c]
+                for k in range(n2):
+                    tidesq[i, j, k] += w*real_batch[c, i, j, k]*real_batch[c, i, j, k]
+    return tidesq
+
+
+@njit(parallel=True, cache=True, fastmath=True)
+def build_laplacian_kernel(delta_k, kx, ky, kz, out):
+    '''
+    Fills out with -k^2 * delta_k, the Fourier transform of nabla^2 delta.
+    '''
+    for i in prange(delta_k.shape[0]):
+        for j in range(delta_k.shape[1]):
+            for k in range(delta_k.shape[2]):
+                k2 = kx[i]*kx[i] + ky[j]*ky[j] + kz[k]*kz[k]
+                out[i, j, k] = -k2*delta_k[i, j, k]
+
+
+if cp is not None:
+    _tide_kernels_cupy = cp.ElementwiseKernel(
+        'complex64 d, float64 kx, float64 ky, float64 kz',
+        'complex64 sxx, complex64 sxy, complex64 sxz, complex64 syy, complex64 syz, complex64 szz',
+        '''
+        double inv_k2 = 1.0/fmax(kx*kx + ky*ky + kz*kz, 2.2250738585072014e-308);
+        sxx = d*(float)(kx*kx*inv_k2 - 1.0/3);
+        sxy = d*(float)(kx*ky*inv_k2);
+        sxz = d*(float)(kx*kz*inv_k2);
+        syy = d*(float)(ky*ky*inv_k2 - 1.0/3);
+        syz = d*(float)(ky*kz*inv_k2);
+        szz = d*(float)(kz*kz*inv_k2 - 1.0/3);
+        ''',
+        'anzu_tide_kernels')
+
+    _laplacian_kernel_cupy = cp.ElementwiseKernel(
+        'complex64 d, float64 kx, float64 ky, float64 kz',
+        'complex64 out',
+        'out = d*(float)(-(kx*kx + ky*ky + kz*kz));',
+        'anzu_laplacian_kernel')
+
+
+def _require_cupy():
+    if cp is None:
+        raise ImportError('The cupy backend needs cupy to be installed.')
+
+
+def tidesq_cupy(delta_k, kx, ky, kz, nmesh):
+    '''
+    GPU version of the s^2 computation for a single, undistributed mesh.
+    delta_k is copied to the device once, all six s_ij are built by one
+    elementwise kernel and inverse transformed in one batched cuFFT call,
+    and only s^2 is copied back.
+
+    The inverse FFT is left unnormalized to match PFFT.backward.
+    '''
+    _require_cupy()
+    d = cp.asarray(delta_k)
+    fft_tide = cp.empty((6,)+d.shape, dtype=cp.complex64)
+    _tide_kernels_cupy(d, cp.asarray(kx)[:,None,None], cp.asarray(ky)[None,:,None],
+                       cp.asarray(kz)[None,None,:], *fft_tide)
+    del d
+
+    real_out = cufft.irfftn(fft_tide, s=(nmesh,)*3, axes=(1,2,3), norm='forward')
+    del fft_tide
+
+    #Off-diagonal terms appear twice in s_ij s_ij
+    weights = cp.asarray([1., 2., 2., 1., 2., 1.], dtype=real_out.dtype)
+    real_out *= real_out
+    tidesq = cp.tensordot(weights, real_out, axes=1)
+
+    return cp.asnumpy(tidesq)
+
+
+def gradsqdelta_cupy(delta_k, kx, ky, kz, nmesh):
+    '''
+    GPU version of nabla^2 delta = IFFT(-k^2 delta_k) for a single,
+    undistributed mesh. The inverse FFT is left unnormalized to match
+    PFFT.backward.
+    '''
+    _require_cupy()
+    ksqdelta = cp.empty(delta_k.shape, dtype=cp.complex64)
+    _laplacian_kernel_cupy(cp.asarray(delta_k), cp.asarray(kx)[:,None,None],
+                           cp.asarray(ky)[None,:,None], cp.asarray(kz)[None,None,:],
+                           ksqdelta)
+    real_gradsqdelta = cufft.irfftn(ksqdelta, s=(nmesh,)*3, axes=(0,1,2), norm='forward')
+
+    return cp.asnumpy(real_gradsqdelta)
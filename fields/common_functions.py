@@ -129,6 +129,25 @@ def position_to_index(pos, lbox, nmesh):
     
     return (idvec%nmesh).astype('int16')
 
+def float32_to_bfloat16(arr):
+    '''
+    Rounds a float32 array to bfloat16 (round to nearest, ties to even) and
+    returns the 16-bit patterns as uint16, for compact on-disk storage.
+    NaNs become quiet NaNs of the same sign, since rounding a NaN with a
+    payload only in the low bits would otherwise carry it into Inf.
+    '''
+    bits = np.ascontiguousarray(arr, dtype=np.float32).view(np.uint32)
+    rounding = ((bits >> 16) & 1) + np.uint32(0x7fff)
+    rounded = ((bits + rounding) >> 16).astype(np.uint16)
+    qnan = ((bits >> 16) & 0x8000).astype(np.uint16) | np.uint16(0x7fc0)
+    return np.where(np.isnan(bits.view(np.float32)), qnan, rounded)
+
+def bfloat16_to_float32(arr):
+    '''
+    Inverse of float32_to_bfloat16: expands uint16 bfloat16 patterns to float32.
+    '''
+    return (np.asarray(arr, dtype=np.uint16).astype(np.uint32) << 16).view(np.float32)
+
 def kroneckerdelta(i, j):
     if i == j:
         return 1
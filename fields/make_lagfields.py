@@ -2,31 +2,191 @@ import numpy as np
 from mpi4py import MPI
 from mpi4py_fft import PFFT, newDistArray
 import time
-import gc
 import sys
 import h5py
 import yaml
-import os
-from common_functions import get_memory, kroneckerdelta
+import functools
+from contextlib import contextmanager
+from collections import namedtuple
+from common_functions import get_memory, float32_to_bfloat16
+from _kernels import build_tide_kernels, reduce_tidesq, build_laplacian_kernel, tidesq_cupy, gradsqdelta_cupy
 
 
 def MPI_mean(array):
     '''
-    Computes the mean of an array that is slab-decomposed across multiple processes.
+    Computes the mean of an array that is distributed across multiple processes,
+    with a single Allreduce of the local sums.
     '''
-    procsum = np.sum(array)*np.ones(1)
-    recvbuf = None
-    if rank==0:
-        recvbuf = np.zeros(shape=[nranks,1])
-    comm.Gather(procsum, recvbuf, root=0)
-    if rank==0:
-        fieldmean = np.ones(1)*np.sum(recvbuf)/nmesh**3
+    procsum = np.array([np.sum(array, dtype='float64')])
+    totalsum = np.zeros(1)
+    comm.Allreduce(procsum, totalsum, op=MPI.SUM)
+    return totalsum[0]/nmesh**3
+
+def open_collective_h5(filename, comm):
+    '''
+    Creates an HDF5 file for parallel writing. Metadata reads and writes are
+    made collective (when h5py/HDF5 support it) so that dataset creation goes
+    through the MPI-IO aggregators instead of every rank hitting the filesystem.
+    '''
+    fapl = h5py.h5p.create(h5py.h5p.FILE_ACCESS)
+    fapl.set_fapl_mpio(comm, MPI.INFO_NULL)
+    if hasattr(fapl, 'set_all_coll_metadata_ops'):
+        fapl.set_all_coll_metadata_ops(True)
+        fapl.set_coll_metadata_write(True)
+    fid = h5py.h5f.create(filename.encode(), h5py.h5f.ACC_TRUNC, fapl=fapl)
+    return h5py.File(fid)
+
+def write_field(h5file, key, field):
+    '''
+    Collectively writes the local part of a DistArray to key/3D/2, the same
+    layout DistArray.write(..., step=2) produces. uint16 datasets hold
+    bfloat16 values, so the field is rounded before writing.
+    '''
+    dset = h5file[key+'/3D/2']
+    local_slice = field.local_slice()
+    if dset.dtype == np.uint16:
+        field = float32_to_bfloat16(field)
+    with dset.collective:
+        dset[local_slice] = field
+
+#MPI datatypes for the dtypes the weight fields can be stored as
+_MPI_TYPES = {np.dtype('float32'): MPI.FLOAT, np.dtype('uint16'): MPI.UNSIGNED_SHORT}
+
+def write_npy_field(filename, field, shape, dtype, comm):
+    '''
+    Writes a distributed field straight into a single .npy file. Rank 0 writes
+    the header, then every rank writes its own part of the mesh in one
+    collective MPI-IO call, so no rank has to hold or serialise the whole mesh.
+    uint16 files hold bfloat16 values, so the field is rounded before writing.
+    '''
+    dtype = np.dtype(dtype)
+    #Plain ints, since numpy writes the shape into the .npy header with repr
+    shape = tuple(int(n) for n in shape)
+    offset = None
+    if comm.Get_rank() == 0:
+        header = np.lib.format.open_memmap(filename, mode='w+', dtype=dtype, shape=shape)
+        offset = header.offset
+        del header
+    offset = comm.bcast(offset, root=0)
+
+    local_slice = field.local_slice()
+    if dtype == np.uint16:
+        field = float32_to_bfloat16(field)
+    data = np.ascontiguousarray(field, dtype=dtype)
+
+    #The last axis is never distributed, so whole rows are the unit of the
+    #file view and of the write. This keeps the MPI count at the number of
+    #local rows, well below the 2^31-1 limit even for a full mesh on one rank.
+    rowtype = _MPI_TYPES[dtype].Create_contiguous(shape[-1])
+    rowtype.Commit()
+    filetype = rowtype.Create_subarray(list(shape[:-1]), list(data.shape[:-1]),
+                                       [s.start for s in local_slice[:-1]])
+    filetype.Commit()
+    fh = MPI.File.Open(comm, filename, MPI.MODE_WRONLY)
+    fh.Set_view(offset, rowtype, filetype)
+    fh.Write_all([data, data.size//shape[-1], rowtype])
+    fh.Close()
+    filetype.Free()
+    rowtype.Free()
+
+class BufferPool(object):
+    '''
+    Recycles real-space DistArrays of an FFT plan. Buffers are borrowed with
+
+    with pool.borrow() as buf:
+        ...
+
+    and go back to the pool at the end of the block, so fields that are
+    never needed at the same time share memory instead of each getting a
+    fresh N^3 allocation.
+    '''
+    def __init__(self, fft):
+        self.fft = fft
+        self.free = []
+
+    @contextmanager
+    def borrow(self):
+        buf = self.free.pop() if self.free else newDistArray(self.fft, False)
+        try:
+            yield buf
+        finally:
+            self.free.append(buf)
+
+    def shrink(self, nfree=0):
+        '''
+        Drops all but nfree idle buffers, so memory that will not be borrowed
+        again is released instead of being held through later stages.
+        '''
+        del self.free[nfree:]
+
+def _check_cupy_backend(nranks):
+    '''
+    The cupy kernels transform the whole mesh on one device, so they cannot
+    work on a slab of a distributed FFT.
+    '''
+    if nranks != 1:
+        raise ValueError('The cupy backend only supports runs with a single MPI rank.')
+
+KGrid = namedtuple('KGrid', 'kx ky kz')
+
+#Above this many ranks fft_grid switches from slab to pencil decomposition by default
+PENCIL_MIN_RANKS = 100
+
+#Number of first-axis planes of the IC mesh read per chunk when loading it
+IC_CHUNK_PLANES = 8
+
+@functools.lru_cache(maxsize=8)
+def _kgrid_1d(nmesh, lbox, kbounds):
+    '''
+    Returns the 1-D wavenumbers along each axis of the local part of an
+    r2c-transformed field. kbounds holds the global (start, stop) index range
+    of that part along each axis, see _local_kbounds. The last axis only
+    holds the non-negative half of the frequencies.
+
+    Results are cached and shared between callers, so the arrays are
+    returned read-only.
+    '''
+    kvals = np.fft.fftfreq(nmesh)*(2*np.pi*nmesh)/lbox
+    kvalsr = np.fft.rfftfreq(nmesh)*(2*np.pi*nmesh)/lbox
+
+    (x0, x1), (y0, y1), (z0, z1) = kbounds
+    kgrid = KGrid(kvals[x0:x1], kvals[y0:y1], kvalsr[z0:z1])
+    for karr in kgrid:
+        karr.flags.writeable = False
+    return kgrid
+
+def _local_kbounds(fft):
+    '''
+    Global index range of this rank's part of the FFT output along each axis.
+    Works for both slab and pencil decompositions.
+    '''
+    return tuple((s.start, s.stop) for s in fft.local_slice(True))
+
+def fft_grid(nranks, decomposition='auto'):
+    '''
+    Processor grid for the PFFT of the mesh.
+
+    'slab' distributes the first axis over all ranks, which means one global
+    Alltoall per transpose. 'pencil' distributes the first two axes on a
+    pr x pc grid with pr*pc = nranks and pr as close to sqrt(nranks) as
+    possible, so each transpose only involves ~sqrt(nranks) ranks (for a
+    prime number of ranks this degenerates to a slab). 'auto'
+    uses pencils above PENCIL_MIN_RANKS ranks, where slabs stop scaling.
+    '''
+    if decomposition == 'auto':
+        decomposition = 'pencil' if nranks > PENCIL_MIN_RANKS else 'slab'
+
+    if decomposition == 'slab':
+        return (-1,)
+    elif decomposition == 'pencil':
+        pr = int(np.sqrt(nranks))
+        while nranks % pr:
+            pr -= 1
+        return (pr, nranks//pr)
     else:
-        fieldmean = np.ones(1)
-    comm.Bcast(fieldmean, root=0)
-    return fieldmean[0]
+        raise ValueError('Unknown FFT decomposition {}'.format(decomposition))
 
-def delta_to_tidesq(delta_k, nmesh, lbox, rank, nranks, fft):
+def delta_to_tidesq(delta_k, nmesh, lbox, rank, nranks, fft, backend='cpu', out=None):
     '''
     Computes the square tidal field from the density FFT
     
@@ -37,104 +197,114 @@ def delta_to_tidesq(delta_k, nmesh, lbox, rank, nranks, fft):
     s_ij = (k_i k_j / k^2 - delta_ij / 3 ) * delta_k
 
     Inputs:
-    delta_k: fft'd density, slab-decomposed. 
+    delta_k: fft'd density, slab- or pencil-decomposed. 
     nmesh: size of the mesh
     lbox: size of the box
     rank: current MPI rank
     nranks: total number of MPI ranks
-    fft: PFFT fourier transform object. Used to do the backwards FFT.
+    fft: PFFT fourier transform object. Its shape and dtype set up the batched backwards FFT.
+    backend: 'cpu' or 'cupy'. The cupy backend runs on a single GPU and needs nranks == 1.
+    out: optional real-space array to write s^2 into.
 
     Outputs: 
-    tidesq: the s^2 field for the given slab.
+    tidesq: the s^2 field for this rank's part of the mesh.
     '''
 
-    kvals = np.fft.fftfreq(nmesh)*(2*np.pi*nmesh)/lbox
-    kvalsmpi = kvals[rank*nmesh//nranks:(rank+1)*nmesh//nranks]
-    kvalsr = np.fft.rfftfreq(nmesh)*(2*np.pi*nmesh)/lbox
-
-    kx, ky, kz = np.meshgrid(kvalsmpi,kvals,  kvalsr)
+    kx, ky, kz = _kgrid_1d(nmesh, lbox, _local_kbounds(fft))
     if rank==0:
-        print(kvals.shape, kvalsmpi.shape, kvalsr.shape, "shape of x, y, z")
+        print(kx.shape, ky.shape, kz.shape, "shape of x, y, z")
 
-    knorm = kx**2 + ky**2 + kz**2
-    if knorm[0][0][0] == 0:
-        knorm[0][0][0] = 1
+    if out is None:
+        out = np.empty(fft.forward.input_array.shape, dtype=fft.forward.input_array.dtype)
 
-    klist = [[kx, kx], [kx, ky], [kx, kz], [ky, ky], [ky, kz], [kz, kz]]
+    if backend == 'cupy':
+        _check_cupy_backend(nranks)
+        out[:] = tidesq_cupy(delta_k, kx, ky, kz, nmesh)
+        return out
 
-    del kx, ky, kz
-    gc.collect()
+    #All six components go through one batched plan, so each transpose is a
+    #single Alltoallw for the whole tensor rather than one per component.
+    #The component axis is not distributed and the mesh axes reuse fft's processor grid.
+    grid = (1,)+tuple(subcomm.Get_size() for subcomm in fft.subcomm)
+    batch_fft = PFFT(MPI.COMM_WORLD, (6,)+tuple(fft.global_shape()), axes=(1,2,3),
+                     dtype=fft.forward.input_array.dtype, grid=grid)
 
-    #Compute the symmetric tide at every Fourier mode which we'll reshape later
+    try:
+        #The batched plan builds its own (reordered) Cartesian communicator, so
+        #check that this rank holds the same global modes as delta_k
+        if tuple(batch_fft.local_slice(True)[1:]) != tuple(fft.local_slice(True)):
+            raise RuntimeError('The batched tidal FFT is not decomposed like the density FFT.')
 
-    #Order is xx, xy, xz, yy, yz, zz
-    jvec = [[0,0], [0,1], [0,2], [1,1], [1,2], [2,2]]
-    tidesq = np.zeros((nmesh//nranks,nmesh,nmesh), dtype='float32')
+        #Compute the symmetric tide at every Fourier mode in a single fused sweep,
+        #straight into the input buffer of the batched plan.
+        #Order is xx, xy, xz, yy, yz, zz
+        fft_tide = batch_fft.backward.input_array
+        build_tide_kernels(delta_k, kx, ky, kz, *fft_tide)
 
-    if rank==0:
-        get_memory()
-    for i in range(len(klist)):
-        karray = (klist[i][0]*klist[i][1]/knorm - kroneckerdelta(jvec[i][0], jvec[i][1])/3.)
-        fft_tide = np.array(karray * (delta_k), dtype='complex64')
+        if rank==0:
+            get_memory()
 
         #this is the local sij
-        real_out = fft.backward(fft_tide)
+        real_out = batch_fft.backward()
+
+        #Off-diagonal terms appear twice in s_ij s_ij
+        weights = np.array([1., 2., 2., 1., 2., 1.], dtype=real_out.dtype)
+        tidesq = reduce_tidesq(real_out, weights, out)
 
         if rank==0:
             get_memory()
-        # fft_tide = fftw.byte_align(fft_tide, fftw.simd_alignment, dtype='complex64')
-        # real_out = fft_tide.view('float32')[:,:,:nmesh]
-        # complex_in = fft_tide[:,:,:]
-        # print(fft_tide.shape, real_out.shape, complex_in.shape)
-        tidesq += 1.*real_out**2
-        if jvec[i][0] != jvec[i][1]:
-            tidesq+= 1.*real_out**2
-            
+
         del fft_tide, real_out
-        gc.collect()
-    # pass
+    finally:
+        #Frees the communicators and transfer datatypes the plan created
+        batch_fft.destroy()
+    del batch_fft
     return tidesq
 
-def delta_to_gradsqdelta(delta_k, nmesh, lbox, rank, nranks, fft):
+def delta_to_gradsqdelta(delta_k, nmesh, lbox, rank, nranks, fft, backend='cpu', out=None):
     '''
     Computes the density curvature from the density FFT
     
     nabla^2 delta = IFFT(-k^2 delta_k)
 
     Inputs:
-    delta_k: fft'd density, slab-decomposed. 
+    delta_k: fft'd density, slab- or pencil-decomposed. 
     nmesh: size of the mesh
     lbox: size of the box
     rank: current MPI rank
     nranks: total number of MPI ranks
     fft: PFFT fourier transform object. Used to do the backwards FFT.
+    backend: 'cpu' or 'cupy'. The cupy backend runs on a single GPU and needs nranks == 1.
+    out: optional real-space array to write nabla^2 delta into. If not given,
+    the result is fft's own backward output buffer.
+
+    delta_k may be fft.backward.input_array itself (which is what fft.forward
+    returns), in which case -k^2 delta_k is computed in place and delta_k is lost.
 
     Outputs: 
-    real_gradsqdelta: the nabla^2delta field for the given slab.
+    real_gradsqdelta: the nabla^2delta field for this rank's part of the mesh.
     '''
 
-    kvals = np.fft.fftfreq(nmesh)*(2*np.pi*nmesh)/lbox
-    kvalsmpi = kvals[rank*nmesh//nranks:(rank+1)*nmesh//nranks]
-    kvalsr = np.fft.rfftfreq(nmesh)*(2*np.pi*nmesh)/lbox
-
-    kx, ky, kz = np.meshgrid(kvalsmpi,kvals,  kvalsr)
+    kx, ky, kz = _kgrid_1d(nmesh, lbox, _local_kbounds(fft))
     if rank==0:
-        print(kvals.shape, kvalsmpi.shape, kvalsr.shape, "shape of x, y, z")
+        print(kx.shape, ky.shape, kz.shape, "shape of x, y, z")
 
-    knorm = kx**2 + ky**2 + kz**2
-    if knorm[0][0][0] == 0:
-        knorm[0][0][0] = 1
+    if backend == 'cupy':
+        _check_cupy_backend(nranks)
+        real_gradsqdelta = gradsqdelta_cupy(delta_k, kx, ky, kz, nmesh)
+        if out is None:
+            return real_gradsqdelta
+        out[:] = real_gradsqdelta
+        return out
 
-    del kx, ky, kz
-    gc.collect()
-    
-    #Compute -k^2 delta which is the gradient
-    ksqdelta = -np.array(knorm * (delta_k), dtype='complex64')
-    
-    real_gradsqdelta = fft.backward(ksqdelta)
+    #Compute -k^2 delta which is the gradient, directly into the plan's input buffer
+    ksqdelta = fft.backward.input_array
+    build_laplacian_kernel(delta_k, kx, ky, kz, ksqdelta)
+
+    real_gradsqdelta = fft.backward(output_array=out)
 
-    
     return real_gradsqdelta
+
 if __name__ == "__main__":
     yamldir = sys.argv[1]
     configs = yaml.load(open(yamldir, 'r'))
@@ -149,106 +319,99 @@ if __name__ == "__main__":
     bigarr = []
     start_time = time.time()
     Lbox = configs['lbox']
+    backend = configs.get('backend', 'cpu')
+    bf16_weightfields = configs.get('bf16_weightfields', False)
+    np_weightfields = configs['np_weightfields']
 
 
     N = np.array([nmesh,nmesh,nmesh], dtype=int)
 
-    fft= PFFT(MPI.COMM_WORLD, N, axes=(0,1,2), dtype='float32', grid=(-1,))
+    fft= PFFT(MPI.COMM_WORLD, N, axes=(0,1,2), dtype='float32',
+              grid=fft_grid(nranks, configs.get('fft_decomposition', 'auto')))
 
     try:
         bigmesh = np.load(lindir+'linICfield.npy', mmap_mode='r')
     except:
         print('Have you run ic_binary_to_field.py yet? Did not find the right file.')
     #print(rank*nmesh//nranks,(rank+1)*nmesh//nranks)
-    u = newDistArray(fft, False)
-
-    #Slab-decompose the noiseless ICs along the distributed array 
-    u[:] = bigmesh[rank*nmesh//nranks:(rank+1)*nmesh//nranks, :, :].astype(u.dtype)
-
-    #Compute the delta^2 field. This operation is local in real space.
-    d2 = newDistArray(fft, False)
-    d2[:] = u*u
-    dmean = MPI_mean(d2)
-
-    #Mean-subtract delta^2 
-    d2 -= dmean
-    if rank==0:
-        print(dmean, ' mean deltasq')
-
-    #Parallel-write delta^2 to hdf5 file
-    d2.write(lindir+'mpi_icfields_nmesh%s.h5'%nmesh, 'deltasq', step=2)
+    #bfloat16 fields are stored as their raw uint16 bit patterns
+    fielddtype = 'uint16' if bf16_weightfields else fft.dtype()
 
-    #Free up memory
-    del d2,dmean
-    gc.collect()
-
-    #Write the linear density field to hdf5
-    u.write(lindir+'mpi_icfields_nmesh%s.h5'%nmesh, 'delta', step=2)
-
-    #Take a forward FFT of the linear density
-    u_hat = fft.forward(u, normalize=True)
-    if rank==0:
-        print('Did backwards FFT')
-
-    #Make a copy of FFT'd linear density. Will be used to make s^2 field.
-    deltak = u_hat.copy()
-    if rank==0:
-        print('Did array copy')
-    tinyfft = delta_to_tidesq(deltak, nmesh, Lbox, rank, nranks, fft)
-    if rank==0:
-        print('Made the tidesq field')
-
-    #Populate output with distarray
-    v = newDistArray(fft, False)
-
-    v[:] = tinyfft
-
-    #Need to compute mean value of tidesq to subtract:
-    vmean = MPI_mean(v)
-    if rank==0:
-        print(vmean, ' mean tidesq')
-    v -= vmean
+    if np_weightfields:
+        #Every rank writes its part of each field straight into the .npy files
+        def save_field(key, field):
+            write_npy_field(lindir+'%s_np.npy'%key, field, (nmesh,)*3, fielddtype, comm)
+    else:
+        #Open the output once and create every dataset up front in one collective pass
+        icfields = open_collective_h5(lindir+'mpi_icfields_nmesh%s.h5'%nmesh, comm)
+        for key in ['delta', 'deltasq', 'tidesq', 'nablasq']:
+            dset = icfields.create_dataset(key+'/3D/2', shape=tuple(N), dtype=fielddtype)
+            if bf16_weightfields:
+                dset.attrs['encoding'] = 'bfloat16'
+
+        def save_field(key, field):
+            write_field(icfields, key, field)
+
+    pool = BufferPool(fft)
+    #u is only needed until the forward FFT, so its buffer goes back to the
+    #pool afterwards and is reused for s^2
+    with pool.borrow() as u:
+        #Decompose the noiseless ICs along the distributed array, streaming a few
+        #planes at a time so no slab-sized temporary is made for the read and cast
+        uslice = u.local_slice()
+        x0, x1 = uslice[0].start, uslice[0].stop
+        for i in range(x0, x1, IC_CHUNK_PLANES):
+            iend = min(i+IC_CHUNK_PLANES, x1)
+            u[i-x0:iend-x0] = bigmesh[(slice(i, iend),)+uslice[1:]]
+
+        with pool.borrow() as d2:
+            #Compute the delta^2 field. This operation is local in real space.
+            np.multiply(u, u, out=d2)
+            dmean = MPI_mean(d2)
+
+            #Mean-subtract delta^2
+            d2 -= dmean
+            if rank==0:
+                print(dmean, ' mean deltasq')
+
+            #Parallel-write delta^2 before its buffer is reused for s^2
+            save_field('deltasq', d2)
+
+        #Write the linear density field
+        save_field('delta', u)
+
+        #Take a forward FFT of the linear density. The result lives in the plan's
+        #own buffer and is only read by delta_to_tidesq, so it is not copied.
+        deltak = fft.forward(u, normalize=True)
+        if rank==0:
+            print('Did backwards FFT')
 
-    v.write(lindir+'mpi_icfields_nmesh%s.h5'%nmesh, 'tidesq', step=2)
+    #Only one real buffer is needed from here on
+    del u, d2
+    pool.shrink(1)
+    with pool.borrow() as v:
+        delta_to_tidesq(deltak, nmesh, Lbox, rank, nranks, fft, backend=backend, out=v)
+        if rank==0:
+            print('Made the tidesq field')
 
-    #clear up space yet again
-    del v, tinyfft,vmean
-    gc.collect()
+        #Need to compute mean value of tidesq to subtract
+        vmean = MPI_mean(v)
+        v -= vmean
+        if rank==0:
+            print(vmean, ' mean tidesq')
 
-    #Now make the nablasq field
-    v = newDistArray(fft, False)
- 
-    nablasq = delta_to_gradsqdelta(deltak, nmesh, Lbox, rank, nranks, fft)
+        save_field('tidesq', v)
 
-    v[:] = nablasq 
+    #Now make the nablasq field in the buffer freed above.
+    #This overwrites deltak, so it has to come after the tidesq field.
+    with pool.borrow() as v:
+        delta_to_gradsqdelta(deltak, nmesh, Lbox, rank, nranks, fft, backend=backend, out=v)
 
-    v.write(lindir+'mpi_icfields_nmesh%s.h5'%nmesh, 'nablasq', step=2)
+        save_field('nablasq', v)
     #Moar space
-    del u, bigmesh, deltak, u_hat,fft,v
-    gc.collect()
-
-    if configs['np_weightfields']:
+    del v, bigmesh, deltak, pool, fft
 
-        if rank==0:
-
-            print('Wrote successfully! Now must convert to .npy files')
-            print(time.time() - start_time," seconds!")
-            get_memory() 
-            f = h5py.File(lindir+'mpi_icfields_nmesh%s.h5'%nmesh, 'r')
-            fkeys = list(f.keys())
-            for key in fkeys:
-                arr = f[key]['3D']['2']
-                print('converting '+key+' to numpy array')
-                np.save(lindir+'%s_np'%key, arr)
-                print(time.time() - start_time, " seconds!")
-                del arr
-                gc.collect()
-                get_memory()
-            #Deletes the hdf5 file 
-            os.system('rm '+lindir+'mpi_icfields_nmesh%s.h5'%nmesh)
-    else: 
-        if rank==0:
-            print('Wrote successfully! Took %d seconds'%(time.time() - start_time))
-# if rank==0:
-# 	print(uj.shape)
-# 	assert np.allclose(uj, u)
+    if not np_weightfields:
+        icfields.close()
+    if rank==0:
+        print('Wrote successfully! Took %d seconds'%(time.time() - start_time))
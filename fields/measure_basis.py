@@ -6,14 +6,13 @@ from nbodykit.algorithms.fftpower import FFTPower
 # from nbodykit.algorithms.fftcorr import FFTCorr
 #from nbodykit.source.mesh import ArrayMesh
 import sys
-import gc
 import pyccl
 import pandas as pd
 import psutil
 import os
 import yaml
 from mpi4py import MPI
-from common_functions import readGadgetSnapshot
+from common_functions import readGadgetSnapshot, bfloat16_to_float32
 def get_memory(rank):
     process = psutil.Process(os.getpid())
     print(process.memory_info().rss/1e9, "GB is current memory usage, rank ", rank)  # in bytes 
@@ -31,10 +30,15 @@ def CompensateCICAliasing(w, v):
         the gridded field with the CIC window function in configuration space,
             as well as the approximate aliasing correction
     From the nbodykit documentation.
+
+    The window is separable, so v is scaled in place by the small
+    per-axis factor along each axis instead of building full-size temporaries.
+    Because v is modified in place, this must only be used with
+    field.apply(..., out=Ellipsis); otherwise the source field is overwritten too.
     """
     for i in range(3):
         wi = w[i]
-        v = v / (1 - 2. / 3 * np.sin(0.5 * wi) ** 2) ** 0.5
+        v *= (1 - 2. / 3 * np.sin(0.5 * wi) ** 2) ** -0.5
     return v
 
 
@@ -120,23 +124,25 @@ lenrand = 0
 
 #Load in a subset of the total gadget snapshot. 
 #TODO: this is hard-coded for Sherlock and Aemulus but should change for generic N-body sims.
+#Collect the per-file blocks and concatenate once, rather than re-stacking the
+#growing arrays for every file read.
+posvec = []
+idvec = []
 for i in range(16*rank, 16*(rank+1)):
     gadgetsnap = readGadgetSnapshot(fdir+'%s'%i, read_id=True, read_pos=True)
 
     gadgetpos = gadgetsnap[1]
 
     gadgetidx = gadgetsnap[2]
-    if i == 16*rank:
-        posvec = 1.*gadgetpos
-        idvec = 1.*gadgetidx
-        mpiprint('here!')
-        mpiprint(posvec.shape)
-    else:
-        posvec = np.vstack((posvec, gadgetpos))
-        idvec = np.hstack((idvec, gadgetidx))
+    posvec.append(gadgetpos)
+    idvec.append(gadgetidx)
     lenrand+=len(gadgetpos)
     del gadgetsnap
-    gc.collect()
+
+posvec = np.concatenate(posvec)
+#IDs stay integers, so the lattice indices below are exact
+idvec = np.concatenate(idvec)
+mpiprint(posvec.shape)
 
 
 #Gadget has IDs starting with ID=1. 
@@ -146,13 +152,13 @@ idfac = 1
 if configs['sim_type'] == 'FastPM':
     idfac = 0
 
-a_ic = ((idvec-idfac)//nmesh**2)%nmesh
-b_ic = ((idvec-idfac)//nmesh)%nmesh
-c_ic = (idvec-idfac)%nmesh
-mpiprint(a_ic[3])
-a_ic = a_ic.astype(int)
-b_ic = b_ic.astype(int)
-c_ic = c_ic.astype(int)
+#Flat index of each particle's Lagrangian cell, i.e. a_ic*nmesh**2 + b_ic*nmesh + c_ic.
+#Reading the weight fields in sorted index order turns the gathers below into one
+#forward pass through each memory-mapped file instead of scattered page reads.
+lagidx = (idvec.astype(np.int64)-idfac)%nmesh**3
+readorder = np.argsort(lagidx)
+lagidx = lagidx[readorder]
+mpiprint(lagidx[3])
 #Figure out where each particle position is going to be distributed among mpi ranks
 layout = pm.decompose(posvec)
 
@@ -163,7 +169,6 @@ mpiprint(('posvec shapes', posvec.shape))
 
 mpiprint(('idvec shapes', idvec.shape))
 del posvec
-gc.collect()
 
 
 
@@ -183,7 +188,12 @@ for k in range(len(fieldlist)):
         arr = np.load(lindir+keynames[k]+'_np.npy', mmap_mode='r')
        
         #Get weights
-        w = arr[a_ic, b_ic, c_ic]
+        w = np.empty(len(lagidx), dtype=arr.dtype)
+        w[readorder] = arr.reshape(-1)[lagidx]
+
+        #Weight fields saved with bf16_weightfields are stored as uint16 bfloat16
+        if arr.dtype == np.uint16:
+            w = bfloat16_to_float32(w)
 
 
         mpiprint(('w shapes', w.shape))
@@ -193,28 +203,30 @@ for k in range(len(fieldlist)):
 
 
         del w
-        gc.collect()
 
         get_memory(rank)
 
         pm.paint(p, out=fieldlist[k], mass = m, resampler='cic')
         sys.stdout.flush()
         del m
-        gc.collect()
 
     #print('painted! ', rank)
     sys.stdout.flush()
 if rank==0:
     print(fieldlist[0].shape)
 del p
-gc.collect()
 if rank==0:
     print('pasted')
     sys.stdout.flush()
 get_memory(rank)
 
-#Normalize and mean-subtract the normal aprticle field.
-fieldlist[0] = fieldlist[0]/fieldlist[0].cmean() - 1
+#Normalize and mean-subtract the normal aprticle field. Done in place on the
+#underlying array, since Field arithmetic allocates a new mesh for every operation.
+pmean = fieldlist[0].cmean()
+delta1 = fieldlist[0].value
+delta1 /= pmean
+delta1 -= 1
+del delta1
 for k in range(len(fieldlist)):
     if rank==0:
         print(np.mean(fieldlist[k].value), np.std(fieldlist[k].value))
@@ -222,7 +234,7 @@ for k in range(len(fieldlist)):
     np.save(componentdir+'latetime_weight_%s_%s_%s_rank%s'%(k,nmesh,fieldnameadd,rank), fieldlist[k].value)
     if compensate:
         fieldlist[k] = fieldlist[k].r2c()
-        fieldlist[k] = fieldlist[k].apply(CompensateCICAliasing, kind='circular')
+        fieldlist[k].apply(CompensateCICAliasing, kind='circular', out=Ellipsis)
 
 get_memory(rank)
 sys.stdout.flush()